@@ -9,6 +9,7 @@ import aiohttp
 from configparser import ConfigParser
 import os
 import tempfile
+import io
 import zipfile
 import bz2
 import re
@@ -16,6 +17,30 @@ import yarl
 import multidict
 import logging
 import sys
+import shutil
+import subprocess
+import asyncio
+import concurrent.futures
+import struct
+import bisect
+import math
+import collections
+import contextlib
+import functools
+import urllib.parse
+import time
+
+# Optional, only needed for zstd compression.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Optional, ISA-L inflates zip members a lot faster than zlib.
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -34,7 +59,212 @@ def get_filename_no_ext(filename: str):
     return name.split('.')[0]
 
 
+"""All the files a map can have."""
+@functools.lru_cache(maxsize=128)
+def get_map_file_names(mapname: str):
+    return (
+        mapname + '.bsp',
+        mapname + '.txt',
+        mapname + '.nav'
+    )
+
+
+# Filename in a Content-Disposition header.
+FILENAME_RE = re.compile(
+    r'filename=(?:"|)((?:\w|.)+?)(?:"|)(?:;|$)',
+    re.MULTILINE)
+# Encoded filename (RFC 6266), takes precedence over the plain one.
+FILENAME_EXT_RE = re.compile(
+    r"filename\*\s*=\s*[\w!#$&+.^`|~-]+'[^']*'([^;\s]+)",
+    re.IGNORECASE)
+
+# Chunk size when copying files around locally.
+COPY_CHUNK_BYTES = 1024 * 1024
+
+# Downloaded chunks are collected up to this size before writing them to disk.
+WRITE_BATCH_BYTES = 4 * 1024 * 1024
+
+# Max number of SFTP channels used to upload files in parallel.
+SFTP_MAX_CHANNELS = 4
+# How long the remote maps listing is trusted, in seconds.
+REMOTE_LISTING_TTL = 30
+
+# How many downloaded URLs we remember the ETag of.
+ETAG_CACHE_SIZE = 64
+# pbzip2 compresses the bz2 blocks of a single file on all cores.
+# We fall back to the bz2 module if it isn't installed.
+PBZIP2_PATH = shutil.which('pbzip2')
+
+# Sample size used to guess if a file is worth compressing hard.
+ENTROPY_SAMPLE_BYTES = 64 * 1024
+# Data above this many bits per byte is (nearly) incompressible.
+ENTROPY_MAX_BITS = 7.5
+
+# Compressed file extension of each supported algorithm.
+COMPRESSION_EXTENSIONS = {
+    'bz2': '.bz2',
+    'zstd': '.zst',
+}
+
+
+"""Compresses a single file with the given algorithm into out_dir.
+    Runs in a worker process, so it has to stay module-level.
+    threads is how many cores pbzip2 gets, the other files need theirs too."""
+def _compress_one(path: str, level: int, ignore_re: re.Pattern, algorithm: str, out_dir: str, threads: int = 1):
+    name = os.path.basename(path)
+    if ignore_re.search(name):
+        return None
+
+    cf_name = os.path.join(out_dir, name + COMPRESSION_EXTENSIONS[algorithm])
+
+    # Still write a valid stream so fast-dl can serve it, just don't burn CPU on it.
+    with open(path, 'rb') as fp:
+        if _is_high_entropy(fp.read(ENTROPY_SAMPLE_BYTES)):
+            logger.debug('%s looks incompressible, using level 1.' % (path))
+            level = 1
+
+    if algorithm == 'zstd':
+        _compress_one_zstd(path, cf_name, level)
+        return cf_name
+
+    if PBZIP2_PATH and _compress_one_pbzip2(path, cf_name, level, threads):
+        return cf_name
+
+    # Streamed in chunks, so memory use stays the same no matter the map size.
+    # Feed the compressor directly, BZ2File only adds overhead.
+    with open(path, 'rb', buffering=0) as ufp:
+        compressor = bz2.BZ2Compressor(level)
+        buf = bytearray(COPY_CHUNK_BYTES)
+        view = memoryview(buf)
+        with open(cf_name, 'wb') as cfp:
+            while True:
+                n = ufp.readinto(buf)
+                if not n:
+                    break
+                cfp.write(compressor.compress(view[:n]))
+            cfp.write(compressor.flush())
+
+    return cf_name
+
+
+"""Whether the data looks already compressed (or otherwise random)."""
+def _is_high_entropy(data: bytes):
+    if not data:
+        return False
+
+    size = len(data)
+    entropy = -sum(
+        (n / size) * math.log2(n / size)
+        for n in collections.Counter(data).values())
+
+    return entropy > ENTROPY_MAX_BITS
+
+
+"""Yields the uncompressed data of a zip member in chunks.
+    Deflated members are inflated with ISA-L if it's installed."""
+def _iter_zip_member(file: zipfile.ZipFile, info: zipfile.ZipInfo, chunk_size: int):
+    # Encrypted members and other compression methods go through zipfile.
+    if (isal_zlib is None or
+            file.fp is None or
+            info.compress_type != zipfile.ZIP_DEFLATED or
+            info.flag_bits & 0x1):
+        with file.open(info) as src:
+            while True:
+                chunk = src.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        return
+
+    fp = file.fp
+    fp.seek(info.header_offset)
+
+    header = fp.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader:
+        raise zipfile.BadZipFile('Truncated file header')
+    fheader = struct.unpack(zipfile.structFileHeader, header)
+    if fheader[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile('Bad magic number for file header')
+
+    # Skip the file name and extra field.
+    fp.seek(fheader[10] + fheader[11], os.SEEK_CUR)
+
+    decompressor = isal_zlib.decompressobj(-15)
+    crc = 0
+    remaining = info.compress_size
+    raw = b''
+    while not decompressor.eof:
+        if not raw:
+            if remaining <= 0:
+                break
+            raw = fp.read(min(chunk_size, remaining))
+            if not raw:
+                raise zipfile.BadZipFile('Truncated file data')
+            remaining -= len(raw)
+
+        # Limit the output so a tiny chunk can't blow up memory usage.
+        data = decompressor.decompress(raw, chunk_size)
+        raw = decompressor.unconsumed_tail
+        if data:
+            crc = isal_zlib.crc32(data, crc)
+            yield data
+
+    data = decompressor.flush()
+    if data:
+        crc = isal_zlib.crc32(data, crc)
+        yield data
+
+    if crc != info.CRC:
+        raise zipfile.BadZipFile('Bad CRC-32 for file %r' % (info.filename))
+
+
+def _new_compressor(algorithm: str, level: int):
+    if algorithm == 'zstd':
+        assert zstandard
+        return zstandard.ZstdCompressor(level=level, threads=-1).compressobj()
+
+    return bz2.BZ2Compressor(level)
+
+
+def _compress_one_zstd(path: str, cf_name: str, level: int):
+    assert zstandard
+
+    # Zstd does the block-level multi-threading itself.
+    cctx = zstandard.ZstdCompressor(level=level, threads=-1)
+
+    with open(path, 'rb') as ufp, open(cf_name, 'wb') as cfp:
+        cctx.copy_stream(
+            ufp, cfp,
+            read_size=COPY_CHUNK_BYTES,
+            write_size=COPY_CHUNK_BYTES)
+
+
+def _compress_one_pbzip2(path: str, cf_name: str, level: int, threads: int):
+    assert PBZIP2_PATH
+
+    try:
+        with open(path, 'rb') as ufp, open(cf_name, 'wb') as cfp:
+            subprocess.run(
+                [
+                    PBZIP2_PATH, '-c', '-z',
+                    '-%i' % (level),
+                    '-p%i' % (threads)
+                ],
+                stdin=ufp,
+                stdout=cfp,
+                stderr=subprocess.PIPE,
+                check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.error('pbzip2 failed to compress %s, falling back to bz2: %s' %
+                     (path, e))
+        return False
+
+    return True
+
+
 class BaseResponse():
+    __slots__ = ('success', 'errors')
+
     def __init__(self):
         self.success = False
         self.errors: list[str] = []
@@ -47,6 +277,8 @@ class BaseResponse():
 
 
 class BaseTopResponse(BaseResponse):
+    __slots__ = ()
+
     def get_errors(self):
         return self.errors
 
@@ -55,37 +287,56 @@ class BaseTopResponse(BaseResponse):
 
 
 class ExtractResponse(BaseResponse):
+    __slots__ = ('files', 'files_extracted', 'files_compressed', 'compressed_dir')
+
     def __init__(self):
         super().__init__()
         # All files for this specific map that exist
         self.files = []
         # All the files extracted, superset of files
         self.files_extracted = []
+        # Compressed fast-dl files written while extracting
+        self.files_compressed = []
+        # Temporary directory holding the compressed files
+        self.compressed_dir = ''
 
 
 class FastDLResponse(BaseResponse):
+    __slots__ = ('files_uploaded',)
+
     def __init__(self):
         super().__init__()
         self.files_uploaded = []
 
 
 class MapCycleResponse(BaseResponse):
+    __slots__ = ('wrote_to_file',)
+
     def __init__(self):
         super().__init__()
         self.wrote_to_file = False
 
 
 class DownloadFileResponse(BaseResponse):
+    __slots__ = ('temp_file', 'buffer', 'map_name', 'etag', 'not_modified')
+
     def __init__(self):
         super().__init__()
         self.temp_file = ''
+        # Small downloads are kept in memory instead of a temp file
+        self.buffer: io.BytesIO | None = None
         self.map_name = ''
+        self.etag = ''
+        # Server told us the file is the same as last time, nothing was downloaded
+        self.not_modified = False
 
 
 #
 # Top responses
 #
 class AddMapToMapCycleResponse(BaseTopResponse):
+    __slots__ = ('fastdl', 'mapcycle')
+
     def __init__(self):
         super().__init__()
         self.fastdl = FastDLResponse()
@@ -109,7 +360,25 @@ class AddMapToMapCycleResponse(BaseTopResponse):
         return True
 
 
+class RemoveMapFromMapCycleResponse(BaseTopResponse):
+    __slots__ = ('mapcycle',)
+
+    def __init__(self):
+        super().__init__()
+        self.mapcycle = MapCycleResponse()
+
+    def get_errors(self):
+        errors = self.errors
+        errors.extend(self.mapcycle.errors)
+        return errors
+
+    def is_success(self):
+        return self.success and self.mapcycle.wrote_to_file
+
+
 class AddMapResponse(BaseTopResponse):
+    __slots__ = ('extract', 'fastdl', 'mapcycle')
+
     def __init__(self):
         super().__init__()
         self.extract = ExtractResponse()
@@ -139,30 +408,120 @@ class AddMapResponse(BaseTopResponse):
 
 class MyDiscordClient(discord.Client):
     def __init__(self, config: ConfigParser):
-        intents = discord.Intents.default()
-        intents.message_content = True
-        super().__init__(intents=intents)
+        # Only what we need, we don't care about members or presences.
+        intents = discord.Intents(
+            guilds=True,
+            messages=True,
+            message_content=True)
+        super().__init__(intents=intents, chunk_guilds_at_startup=False)
 
         self.my_channel = None
         # self.my_guild = None
 
         self.token = config.get('discord', 'token')
-        self.channel_id = int(config.get('discord', 'channel'))
+        self.channel_id = config.getint('discord', 'channel')
 
-        self.upload_chunksize = int(config.get('upload', 'chunksize'))
-        self.upload_max_bytes = int(config.get('upload', 'maxbytes'))
+        self.upload_chunksize = config.getint('upload', 'chunksize', fallback=COPY_CHUNK_BYTES)
+        self.upload_max_bytes = config.getint('upload', 'maxbytes')
+        # Downloads up to this size never touch the disk.
+        self.upload_memory_bytes = config.getint('upload', 'memorybytes', fallback=33554432)
+        # Commands doing the heavy lifting (download, compress, upload) at once.
+        self.max_jobs = config.getint('upload', 'maxjobs', fallback=2)
 
         self.maps_dir = os.path.abspath(config.get('server', 'mapsdir'))
+        # Maps directory mtime and the file names in it.
+        self._local_maps: tuple[int, set[str]] | None = None
+        # URL -> (ETag, map name) of maps we've already extracted.
+        self._etags: collections.OrderedDict[str, tuple[str, str, tuple[str, ...]]] = collections.OrderedDict()
         self.mapcycle_file = config.get('server', 'mapcyclefile')
+        # Mapcycle contents as of the file's last modification time.
+        self._mapcycle: list[str] | None = None
+        self._mapcycle_mtime = 0
         self.mapcycle_regex = config.get('server', 'mapcycleregex')
+        self._mapcycle_re = re.compile(self.mapcycle_regex)
+        # The same mapcycle lines get keyed over and over, remember them.
+        self.mapcycle_sort = functools.lru_cache(maxsize=4096)(self.mapcycle_sort)
 
         self.sftp_hostname = config.get('sftp', 'hostname')
         self.sftp_username = config.get('sftp', 'username')
         self.sftp_password = config.get('sftp', 'password')
         self.sftp_remote_maps = config.get('sftp', 'mapsdir')
+        # Size of each SFTP write and how many of them can be in flight per file.
+        self.sftp_block_size = config.getint('sftp', 'blocksize', fallback=32768)
+        self.sftp_max_requests = config.getint('sftp', 'maxrequests', fallback=64)
+        # Max SFTP operations running at once, over all commands.
+        self.sftp_max_concurrent = config.getint('sftp', 'maxconcurrent', fallback=4)
+        # Algorithms to negotiate, in order of preference.
+        # Empty (or missing) means asyncssh's defaults.
+        self.sftp_encryption_algs = self.get_config_list(
+            config, 'sftp', 'encryptionalgs', '')
+        self.sftp_mac_algs = self.get_config_list(
+            config, 'sftp', 'macalgs', '')
+        self.sftp_compression_algs = self.get_config_list(
+            config, 'sftp', 'compressionalgs', '')
 
         self.bz2_ignore_regex = config.get('bz2', 'ignoreregex')
-        self.bz2_compressionlevel = int(config.get('bz2', 'compressionlevel'))
+        self._ignore_re = re.compile(self.bz2_ignore_regex)
+        self.bz2_compressionlevel = config.getint('bz2', 'compressionlevel', fallback=3)
+        if self.bz2_compressionlevel > 5:
+            logger.warning(
+                'bz2 compression level %i barely shrinks maps more than 5 '
+                'but takes a lot longer. Consider lowering it.' %
+                (self.bz2_compressionlevel))
+
+        self.compression_algorithm = config.get(
+            'bz2', 'algorithm', fallback='bz2')
+        if self.compression_algorithm not in COMPRESSION_EXTENSIONS:
+            raise ValueError('Unknown compression algorithm "%s"!' %
+                             (self.compression_algorithm))
+        if self.compression_algorithm == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires the zstandard package!')
+
+        self.compression_ext = COMPRESSION_EXTENSIONS[self.compression_algorithm]
+        if self.compression_algorithm == 'zstd':
+            self.compression_level = config.getint('bz2', 'zstdlevel', fallback=15)
+        else:
+            self.compression_level = self.bz2_compressionlevel
+
+        # Compression is CPU-bound, spread the files over multiple cores.
+        self._cpu_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=os.cpu_count())
+
+        # Created in setup_hook, needs a running event loop.
+        self._http: aiohttp.ClientSession | None = None
+
+        # Persistent SSH connection, opened on first use.
+        self._ssh_conn: asyncssh.SSHClientConnection | None = None
+        self._sftp: asyncssh.SFTPClient | None = None
+        # Finishes once the SSH connection gets closed.
+        self._ssh_closed: asyncio.Task | None = None
+        self._sftp_lock = asyncio.Lock()
+        self._sftp_sem = asyncio.Semaphore(self.sftp_max_concurrent)
+        self._jobs_sem = asyncio.Semaphore(self.max_jobs)
+        # Cached listing of the remote maps directory and when it was taken.
+        self._remote_files: set[str] | None = None
+        self._remote_files_time = 0.0
+        # Serializes read-modify-write of the mapcycle.
+        self._mapcycle_lock = asyncio.Lock()
+
+        # Command name: (handler, success message, failure message)
+        self._commands = {
+            # Add map through url
+            'addmap': (
+                self.add_map,
+                'Success!',
+                'Failed to upload map.'),
+            # Add map to mapcycle (+ add to fast-dl)
+            'addmapcycle': (
+                self.add_mapcycle,
+                'Success!',
+                'Failed to add map to mapcycle!'),
+            # Remove map from mapcycle
+            'removemapcycle': (
+                self.remove_mapcycle,
+                'Removed map from mapcycle.',
+                'Failed to remove map from mapcycle!'),
+        }
 
         self.init_done = False
         self.exitcode = 0
@@ -212,48 +571,42 @@ class MyDiscordClient(discord.Client):
         #
         # Actual actions.
         #
+        cmd, _, arg = message.content[1:].partition(' ')
 
-        # Add map through url
-        if message.content.startswith('addmap ', 1):
-            ret = await self.add_map(
-                    message.content[len('!addmap '):])
+        command = self._commands.get(cmd)
+        if command is None or not arg:
+            return
 
-            if ret.is_success():
-                await self.quick_channel_msg(
-                    '%s Success! %s' %
-                    (message.author.mention, '\n'.join(ret.get_errors())))
-            else:
-                await self.quick_channel_msg(
-                    '%s Failed to upload map. %s' %
-                    (message.author.mention, '\n'.join(ret.get_errors())))
-
-        # Add map to mapcycle (+ add to fast-dl)
-        if message.content.startswith('addmapcycle ', 1):
-            ret = await self.add_mapcycle(
-                    message.content[len('!addmapcycle '):])
-
-            if ret.is_success():
-                await self.quick_channel_msg(
-                    '%s Success! %s' %
-                    (message.author.mention, '\n'.join(ret.get_errors())))
-            else:
-                await self.quick_channel_msg(
-                    '%s Failed to add map to mapcycle! %s' %
-                    (message.author.mention, '\n'.join(ret.get_errors())))
-
-        # Remove map from mapcycle
-        if message.content.startswith('removemapcycle ', 1):
-            ret = await self.remove_mapcycle(
-                    message.content[len('!removemapcycle '):])
-
-            if ret:
-                await self.quick_channel_msg(
-                    '%s Removed map from mapcycle.' %
-                    (message.author.mention))
-            else:
-                await self.quick_channel_msg(
-                    '%s Failed to remove map from mapcycle!' %
-                    (message.author.mention))
+        # discord.py runs every event in its own task, so commands already
+        # run concurrently. Just don't let too many of them pile up.
+        handler, success_msg, fail_msg = command
+        async with self._jobs_sem:
+            ret = await handler(arg)
+
+        await self.quick_channel_msg(
+            '%s %s %s' %
+            (message.author.mention,
+             success_msg if ret.is_success() else fail_msg,
+             '\n'.join(ret.get_errors())))
+
+    async def setup_hook(self):
+        # Sized pool for all the blocking file work.
+        self.loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(
+            max_workers=8,
+            thread_name_prefix='mapupload-io'))
+
+        # One session for all downloads, so connections get reused.
+        self._http = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300),
+            # Give up on servers that stop sending data halfway through.
+            timeout=aiohttp.ClientTimeout(total=300, sock_read=30))
+
+    async def close(self):
+        await super().close()
+        if self._http:
+            await self._http.close()
+        await self._close_sftp()
+        self._cpu_pool.shutdown(wait=False, cancel_futures=True)
 
     #
     # Discord utils
@@ -277,8 +630,16 @@ class MyDiscordClient(discord.Client):
 
         #
         # Download
+        # Don't download the same file again if we still have all of its files.
         #
-        data = await self.download_file(url)
+        etag = ''
+        cached = self._etags.get(url)
+        if cached:
+            existing = await asyncio.to_thread(self.list_local_maps)
+            if all(f in existing for f in cached[2]):
+                etag = cached[0]
+
+        data = await self.download_file(url, etag)
         resp.copy_errors(data)
 
         if not data.success:
@@ -288,23 +649,31 @@ class MyDiscordClient(discord.Client):
         #
         # Extract from ZIP
         #
-        extract_resp = None
-
-        if zipfile.is_zipfile(data.temp_file):
-            extract_resp = await self.loop.run_in_executor(
-                None,
-                self.extract_zip,
-                data)
-
-        if not extract_resp:
-            resp.error('File must be a .zip file!')
-            return resp
+        if data.not_modified:
+            assert cached
+            logger.info('File has not changed since the last download.')
+            data.map_name = cached[1]
+            extract_resp = ExtractResponse()
+            extract_resp.error('File has not changed since it was last added.')
+            extract_resp.files = [os.path.join(self.maps_dir, f) for f in cached[2]]
+            extract_resp.success = True
+        else:
+            extract_resp = await asyncio.to_thread(self.extract_zip, data)
 
         resp.extract = extract_resp
 
         if not extract_resp.success:
             return resp
 
+        if data.etag and extract_resp.files:
+            self._etags[url] = (
+                data.etag,
+                data.map_name,
+                tuple(os.path.basename(f) for f in extract_resp.files))
+            self._etags.move_to_end(url)
+            while len(self._etags) > ETAG_CACHE_SIZE:
+                self._etags.popitem(last=False)
+
         if not len(extract_resp.files_extracted):
             resp.errors = ['No files were extracted.'] + resp.errors
 
@@ -315,7 +684,14 @@ class MyDiscordClient(discord.Client):
         #
         # Add map to fast-dl
         #
-        resp.fastdl = await self.add_map_to_fastdl(data.map_name)
+        try:
+            resp.fastdl = await self.add_map_to_fastdl(
+                data.map_name,
+                precompressed=extract_resp.files_compressed)
+        finally:
+            if extract_resp.compressed_dir:
+                logger.info('Removing local compressed files...')
+                await asyncio.to_thread(shutil.rmtree, extract_resp.compressed_dir, True)
 
         if not resp.fastdl.success:
             return resp
@@ -343,9 +719,7 @@ class MyDiscordClient(discord.Client):
         #
         # Get map files (make sure it exists)
         #
-        files = await self.loop.run_in_executor(
-            None,
-            self.get_map_files, mapname, True)
+        files = await asyncio.to_thread(self.get_map_files, mapname, True)
 
         if not files:
             resp.error('Map does not exist!')
@@ -376,79 +750,182 @@ class MyDiscordClient(discord.Client):
 
         logger.info('Removing map %s from mapcycle...' % (mapname))
 
-        return await self.remove_from_mapcycle(mapname)
+        resp = RemoveMapFromMapCycleResponse()
+
+        resp.mapcycle = await self.remove_from_mapcycle(mapname)
+
+        if not resp.mapcycle.success:
+            return resp
+
+        resp.success = True
+        return resp
 
     #
     # Lower routines
     #
-    async def download_file(self, url: str):
+    async def download_file(self, url: str, etag=''):
         data = DownloadFileResponse()
 
-        async with aiohttp.ClientSession() as session:
-            try:
-                async with session.get(url) as resp:
-                    await self.parse_response(resp, data)
-            except (aiohttp.ClientResponseError) as e:
-                logger.error('Response error: %s' % (e))
-            except (aiohttp.InvalidURL) as e:
-                data.error('Invalid URL: %s' %
-                           (escape_everything(url)))
-                logger.error('Invalid URL (%s): %s' % (url, e))
+        assert self._http
+
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+
+        try:
+            async with self._http.get(url, headers=headers) as resp:
+                if etag and resp.status == 304:
+                    data.etag = etag
+                    data.not_modified = True
+                    data.success = True
+                    return data
+
+                data.etag = resp.headers.get('ETag', '')
+                await self.parse_response(resp, data)
+        except (aiohttp.ClientResponseError) as e:
+            logger.error('Response error: %s' % (e))
+        except (aiohttp.InvalidURL) as e:
+            data.error('Invalid URL: %s' %
+                       (escape_everything(url)))
+            logger.error('Invalid URL (%s): %s' % (url, e))
 
         return data
 
-    async def upload_files(self, files: list[str], override=False):
+    """Uploads files from the queue as they come in,
+        until it gets a None.
+        Returns the uploaded files and the ones that failed."""
+    async def upload_files(self, queue: 'asyncio.Queue[str | None]', num_channels: int):
         logger.info('Uploading files to SFTP...')
 
-        uploaded = -1
+        uploaded: list[str] = []
+        failed: list[str] = []
+        conn_lost = False
+
+        # Each file gets its own SFTP channel on the same connection.
+        channels = []
+        try:
+            conn, sftp = await self._get_sftp()
+            channels.append(sftp)
+
+            for _ in range(num_channels - 1):
+                channels.append(await conn.start_sftp_client())
+        except (OSError, asyncssh.Error) as e:
+            logger.error('SSH/SFTP Exception: ' + str(e))
+            await self._close_sftp()
+            # All channels share the connection, once it's gone they're all dead.
+            conn_lost = True
+
+        async def upload(chan: asyncssh.SFTPClient | None):
+            nonlocal conn_lost
+
+            while True:
+                f = await queue.get()
+                if f is None:
+                    # Let the other channels know too.
+                    queue.put_nowait(None)
+                    break
+
+                # Keep draining the queue so the producer doesn't get stuck.
+                # A single file failing doesn't stop the others.
+                if conn_lost or chan is None:
+                    failed.append(f)
+                    continue
+
+                try:
+                    async with self._sftp_sem:
+                        await chan.put(
+                            f,
+                            remotepath=self.sftp_remote_maps,
+                            block_size=self.sftp_block_size,
+                            max_requests=self.sftp_max_requests)
+                    uploaded.append(f)
+                    if self._remote_files is not None:
+                        self._remote_files.add(os.path.basename(f))
+                except (OSError, asyncssh.SFTPError) as e:
+                    logger.error('Exception putting files: ' + str(e))
+                    failed.append(f)
+                except asyncssh.Error as e:
+                    # Connection went away, reconnect next time.
+                    logger.error('SSH Exception putting files: ' + str(e))
+                    await self._close_sftp()
+                    failed.append(f)
+                    conn_lost = True
 
         try:
-            async with asyncssh.connect(
+            await asyncio.gather(*(upload(chan) for chan in channels or [None]))
+        finally:
+            # Only the first channel is cached.
+            for chan in channels[1:]:
+                chan.exit()
+
+        return uploaded, failed
+
+    """Returns the file names in the remote maps directory.
+        The listing is cached for a bit, uploads keep it up to date."""
+    async def list_remote_maps(self, sftp: asyncssh.SFTPClient):
+        now = time.monotonic()
+        if (self._remote_files is not None and
+                now - self._remote_files_time < REMOTE_LISTING_TTL):
+            return self._remote_files
+
+        async with self._sftp_sem:
+            entries = await sftp.readdir(self.sftp_remote_maps)
+
+        # Empty files are left over from failed uploads, upload them again.
+        self._remote_files = {
+            e.filename for e in entries if e.attrs.size != 0}
+        self._remote_files_time = now
+
+        return self._remote_files
+
+    """Returns the cached SSH connection and its SFTP client, (re)connecting if needed."""
+    async def _get_sftp(self):
+        async with self._sftp_lock:
+            if (self._sftp is None or self._ssh_conn is None or
+                    self._ssh_closed is None or self._ssh_closed.done()):
+                try:
+                    options = self.get_ssh_conn_options()
+                except ValueError as e:
+                    # Unknown algorithm names in the config.
+                    raise OSError('Invalid SSH connection options: %s' % (e)) from e
+
+                self._ssh_conn = await asyncssh.connect(
                     host=self.sftp_hostname,
-                    options=self.get_ssh_conn_options()) as conn:
+                    options=options)
+                self._ssh_closed = asyncio.create_task(
+                    self._ssh_conn.wait_closed())
                 logger.info('Established SSH connection server.')
 
-                async with conn.start_sftp_client() as sftp:
-                    logger.info('Established SFTP.')
-
-                    # Check if those files exist.
-                    if not override:
-                        try:
-                            old_files = files[:]
-                            for f in old_files:
-                                full_path = os.path.join(
-                                    self.sftp_remote_maps,
-                                    os.path.basename(f))
-                                if await sftp.exists(full_path):
-                                    files.remove(f)
-                        except (asyncssh.SFTPError) as e:
-                            logger.error('Exception checking files: ' + str(e))
-
-                    # Finally, upload them
-                    try:
-                        await sftp.put(
-                            files,
-                            remotepath=self.sftp_remote_maps)
+                self._sftp = await self._ssh_conn.start_sftp_client()
+                logger.info('Established SFTP.')
 
-                        uploaded = len(files)
-                    except (OSError, asyncssh.SFTPError) as e:
-                        logger.error('Exception putting files: ' + str(e))
+            return self._ssh_conn, self._sftp
 
-                logger.debug('Closed SFTP connection.')
+    """Closes the cached SSH connection, if any."""
+    async def _close_sftp(self):
+        async with self._sftp_lock:
+            conn = self._ssh_conn
+            self._ssh_conn = None
+            self._sftp = None
+            self._ssh_closed = None
+            # Don't trust the listing after an error.
+            self._remote_files = None
 
+        if conn:
+            conn.close()
+            await conn.wait_closed()
             logger.debug('Closed SSH connection.')
 
-        except (OSError, asyncssh.SFTPError) as e:
-            logger.error('SSH/SFTP Exception: ' + str(e))
-
-        return uploaded
-
     async def insert_into_mapcycle(self, mapname: str):
+        async with self._mapcycle_lock:
+            return await self._insert_into_mapcycle(mapname)
+
+    async def _insert_into_mapcycle(self, mapname: str):
         logger.info('Inserting map %s into mapcycle...' % (mapname))
 
         resp = MapCycleResponse()
 
-        maps = await self.loop.run_in_executor(None, self.read_mapcycle)
+        maps = await asyncio.to_thread(self.read_mapcycle)
 
         if maps is None:
             logger.info('Mapcycle does not exists!')
@@ -460,13 +937,10 @@ class MyDiscordClient(discord.Client):
             resp.success = True
             return resp
 
-        sorted_maps = maps
-        sorted_maps.append(mapname)
-        sorted_maps = sorted(maps, key=self.mapcycle_sort)
+        # The mapcycle is kept sorted, just find the spot for the new map.
+        bisect.insort(maps, mapname, key=self.mapcycle_sort)
 
-        wrote = await self.loop.run_in_executor(
-            None,
-            self.save_mapcycle, sorted_maps)
+        wrote = await asyncio.to_thread(self.save_mapcycle, maps)
 
         if wrote:
             resp.wrote_to_file = True
@@ -475,28 +949,37 @@ class MyDiscordClient(discord.Client):
         return resp
 
     async def remove_from_mapcycle(self, mapname: str):
-        mapcycle = await self.loop.run_in_executor(None, self.read_mapcycle)
+        async with self._mapcycle_lock:
+            return await self._remove_from_mapcycle(mapname)
+
+    async def _remove_from_mapcycle(self, mapname: str):
+        resp = MapCycleResponse()
+
+        mapcycle = await asyncio.to_thread(self.read_mapcycle)
 
         if mapcycle is None:
-            return False
+            logger.info('Mapcycle does not exists!')
+            return resp
 
-        removed = False
-        for lmap in mapcycle:
-            if re.match(mapname, lmap):
-                mapcycle.remove(lmap)
-                removed = True
-                break
+        # Look the map up by its exact name, not as a regex pattern.
+        lmap = self._index_mapcycle(mapcycle).get(mapname.lower())
 
-        if removed:
-            wrote = await self.loop.run_in_executor(
-                None,
-                self.save_mapcycle, mapcycle)
-            return wrote
+        if lmap is None:
+            resp.error('Map %s is not in mapcycle.' % (mapname))
+            return resp
 
-        return False
+        mapcycle.remove(lmap)
+
+        wrote = await asyncio.to_thread(self.save_mapcycle, mapcycle)
+
+        if wrote:
+            resp.wrote_to_file = True
+            resp.success = True
+
+        return resp
 
     """Add map to fast-dl if we have any files to add."""
-    async def add_map_to_fastdl(self, mapname: str, override_files=False):
+    async def add_map_to_fastdl(self, mapname: str, override_files=False, precompressed: list[str] | None = None):
         mapname = get_filename_no_ext(mapname)
 
         logger.info('Adding map %s to fast-dl...' % (mapname))
@@ -504,9 +987,7 @@ class MyDiscordClient(discord.Client):
         resp = FastDLResponse()
 
         # Add local path, upload only files
-        files = await self.loop.run_in_executor(
-            None,
-            self.get_map_files, mapname, True, True)
+        files = await asyncio.to_thread(self.get_map_files, mapname, True, True)
 
         # We don't have this map's files!
         if not files:
@@ -517,33 +998,24 @@ class MyDiscordClient(discord.Client):
         # Check if those files exist on the fast-dl.
         if not override_files:
             try:
-                async with asyncssh.connect(
-                        host=self.sftp_hostname,
-                        options=self.get_ssh_conn_options()) as conn:
-                    logger.info('Established SSH connection server.')
-
-                    async with conn.start_sftp_client() as sftp:
-                        logger.info('Established SFTP.')
-
-                        logger.info('Checking for any existing files...')
-                        files_exist = []
-                        try:
-                            for f in files:
-                                full_path = os.path.join(
-                                    self.sftp_remote_maps,
-                                    os.path.basename(f + '.bz2'))
-                                if await sftp.exists(full_path):
-                                    print('%s already exists' % (full_path))
-                                    files_exist.append(f)
-                        except (asyncssh.SFTPError) as e:
-                            logger.error('Exception checking files: %s' % (e))
-
-                    logger.debug('Closed SFTP connection.')
-
-                logger.debug('Closed SSH connection.')
-
-            except (OSError, asyncssh.SFTPError) as e:
+                _, sftp = await self._get_sftp()
+
+                logger.info('Checking for any existing files...')
+                files_exist = []
+                try:
+                    # One listing instead of a round trip per file.
+                    remote_files = await self.list_remote_maps(sftp)
+                    for f in files:
+                        name = os.path.basename(f + self.compression_ext)
+                        if name in remote_files:
+                            logger.info('%s already exists' % (name))
+                            files_exist.append(f)
+                except (asyncssh.SFTPError) as e:
+                    logger.error('Exception checking files: %s' % (e))
+
+            except (OSError, asyncssh.Error) as e:
                 logger.error('SSH/SFTP Exception: ' + str(e))
+                await self._close_sftp()
 
             if files_exist is None:
                 logger.info('Error occurred checking %s fast-dl files.' % (mapname))
@@ -557,53 +1029,79 @@ class MyDiscordClient(discord.Client):
 
             if len(files_exist) > 0:
                 logger.info('Fast-dl already had some of the map files...')
-                for f in files_exist:
-                    files.remove(f)
+                skip = set(files_exist)
+                files = [f for f in files if f not in skip]
 
         #
         # Compress the files with BZIP2
+        # Files that were compressed while extracting can be used as is.
+        #
+        # Files get uploaded as soon as they are compressed.
         #
-        compressed_files = await self.loop.run_in_executor(
-            None,
-            self.compress_to_bz2,
-            files)
+        precompressed_by_name = {
+            os.path.basename(f): f for f in precompressed or []}
+        compressed_files = []
+        to_compress = []
+        for f in files:
+            cf = precompressed_by_name.get(
+                os.path.basename(f) + self.compression_ext)
+            if cf:
+                compressed_files.append(cf)
+            else:
+                to_compress.append(f)
 
-        if not compressed_files:
-            resp.error('No files were compressed!')
-            return resp
+        queue: asyncio.Queue[str | None] = asyncio.Queue()
+        for f in compressed_files:
+            queue.put_nowait(f)
+
+        # Everything we compress goes in here, removed in one go afterwards.
+        work_dir = await asyncio.to_thread(tempfile.mkdtemp, prefix='mapupload_')
+
+        async def compress():
+            try:
+                return await self.compress_to_bz2(to_compress, work_dir, queue)
+            finally:
+                # No more files coming.
+                queue.put_nowait(None)
 
         #
         # Upload
         #
-        uploaded = await self.upload_files(compressed_files)
+        try:
+            async with asyncio.TaskGroup() as tg:
+                compress_task = tg.create_task(compress())
+                upload_task = tg.create_task(self.upload_files(
+                    queue,
+                    min(len(files), SFTP_MAX_CHANNELS)))
+        finally:
+            # The caller owns the precompressed files.
+            logger.info('Removing local compressed files...')
+            await asyncio.to_thread(shutil.rmtree, work_dir, True)
+
+        compressed_files.extend(compress_task.result())
+        uploaded, failed = upload_task.result()
 
-        resp.files_uploaded = compressed_files
+        if not compressed_files:
+            resp.error('No files were compressed!')
+            return resp
 
-        if uploaded == -1:
-            resp.error('Failed to upload files to fast-dl!')
+        resp.files_uploaded = uploaded
 
-        logger.info('Removing local compressed files...')
-        # Is this blocking?
-        for f in compressed_files:
-            os.remove(f)
+        if failed:
+            resp.error('Failed to upload files to fast-dl: %s' %
+                       (', '.join(os.path.basename(f) for f in failed)))
 
         resp.success = True
         return resp
 
     async def map_exists_in_mapcycle(self, mapname: str, mapcycle: list[str] | None):
-        if not mapcycle:
-            mapcycle = await self.loop.run_in_executor(
-                None,
-                self.read_mapcycle)
-            
         if mapcycle is None:
-            return
+            mapcycle = await asyncio.to_thread(self.read_mapcycle)
 
-        for lmap in mapcycle:
-            if re.match(mapname, lmap):
-                return True
+        if mapcycle is None:
+            return
 
-        return False
+        return mapname.lower() in self._index_mapcycle(mapcycle)
 
     async def parse_response(self, resp: aiohttp.ClientResponse, ret_data: DownloadFileResponse):
         if 'Content-Length' not in resp.headers:
@@ -628,7 +1126,6 @@ class MyDiscordClient(discord.Client):
         content_len = int(resp.headers['Content-Length'])
         logger.info('Content Length: %i' % (content_len))
 
-        self.get_filename_from_url(resp.url)
         filename = self.get_filename_from_headers(resp.headers)
 
         # Try url
@@ -650,7 +1147,10 @@ class MyDiscordClient(discord.Client):
                   (self.upload_max_bytes))
             return ret_data
 
-        await self.write_response_to_tempfile(resp, ret_data)
+        if content_len <= self.upload_memory_bytes:
+            await self.write_response_to_buffer(resp, ret_data, content_len)
+        else:
+            await self.write_response_to_tempfile(resp, ret_data, content_len)
 
     #
     # Blocking
@@ -659,10 +1159,19 @@ class MyDiscordClient(discord.Client):
         maps = None
 
         try:
+            mtime = os.stat(self.mapcycle_file).st_mtime_ns
+
+            # Nobody touched the file since we last read it.
+            if self._mapcycle is not None and mtime == self._mapcycle_mtime:
+                return list(self._mapcycle)
+
             with open(self.mapcycle_file, 'r') as fp:
                 maps = fp.read().splitlines()
+
+            self._mapcycle = list(maps)
+            self._mapcycle_mtime = mtime
         except FileNotFoundError:
-            pass
+            self._mapcycle = None
         except OSError as e:
             logger.error('Unexpected error reading mapcycle: %s' % (e))
 
@@ -672,57 +1181,192 @@ class MyDiscordClient(discord.Client):
         logger.info('Saving maps to mapcycle...')
 
         ok = False
+        data = '\n'.join(maps) + '\n'
 
+        # Write to a temporary file and swap it in,
+        # so a crash can't leave a half-written mapcycle behind.
+        # Replace what a symlink points to, not the link itself.
+        target = os.path.realpath(self.mapcycle_file)
+        tmp_file = target + '.tmp'
         try:
-            with open(self.mapcycle_file, 'w') as fp:
-                fp.write('\n'.join(maps))
-                fp.write('\n')
+            with open(tmp_file, 'w') as fp:
+                fp.write(data)
+                # Make sure the data is on disk before the swap.
+                fp.flush()
+                os.fsync(fp.fileno())
+
+            # Keep the permissions and owner of the file we replace.
+            try:
+                st = os.stat(target)
+            except FileNotFoundError:
+                st = None
+            if st:
+                shutil.copymode(target, tmp_file)
+                if hasattr(os, 'chown'):
+                    try:
+                        os.chown(tmp_file, st.st_uid, st.st_gid)
+                    except PermissionError:
+                        pass
+
+            os.replace(tmp_file, target)
             ok = True
         except OSError as e:
-            logger.error('Error writing mapcycle: %s' % (e))
+            # Can't replace a bind-mounted file (docker), write it in place.
+            logger.debug('Could not replace mapcycle atomically: %s' % (e))
+            try:
+                self.remove_file(tmp_file)
+            except OSError as e:
+                logger.error('Could not remove %s: %s' % (tmp_file, e))
+
+        if not ok:
+            try:
+                with open(self.mapcycle_file, 'w') as fp:
+                    fp.write(data)
+                ok = True
+            except OSError as e:
+                logger.error('Error writing mapcycle: %s' % (e))
+
+        if ok:
+            self._mapcycle = list(maps)
+            try:
+                self._mapcycle_mtime = os.stat(self.mapcycle_file).st_mtime_ns
+            except OSError:
+                self._mapcycle = None
 
         return ok
 
+    """Returns the file names in the maps directory.
+        The listing is only read again once the directory changes."""
+    def list_local_maps(self):
+        try:
+            mtime = os.stat(self.maps_dir).st_mtime_ns
+        except OSError:
+            return set()
+
+        cached = self._local_maps
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        try:
+            names = {e.name for e in os.scandir(self.maps_dir)}
+        except OSError:
+            return set()
+
+        # Swapped in one go, this gets called from worker threads.
+        self._local_maps = (mtime, names)
+        return names
+
+    def remove_file(self, path: str):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def remove_download(self, data: DownloadFileResponse):
+        if data.buffer:
+            data.buffer = None
+        else:
+            self.remove_file(data.temp_file)
+
     def extract_zip(self, data: DownloadFileResponse):
         ret = ExtractResponse()
 
-        logger.info('Extracting ZIP contents of %s...' % (data.temp_file))
+        if data.buffer:
+            logger.info('Extracting ZIP contents from memory...')
+        else:
+            logger.info('Extracting ZIP contents of %s...' % (data.temp_file))
 
-        if not os.path.exists(data.temp_file):
-            logger.info('Zip file %s does not exist!' % (data.temp_file))
-            return ret
+            if not os.path.exists(data.temp_file):
+                logger.info('Zip file %s does not exist!' % (data.temp_file))
+                return ret
 
         safe_extract = self.get_map_files(data.map_name)
 
-        with zipfile.ZipFile(data.temp_file) as file:
-            for f in safe_extract:
-                out_file = os.path.join(self.maps_dir, f)
+        # Each worker reads through its own ZipFile,
+        # they can't share the file position.
+        if data.buffer:
+            raw = data.buffer.getvalue()
+            def open_zip():
+                return zipfile.ZipFile(io.BytesIO(raw))
+        else:
+            # Buffer reads a lot bigger than zipfile's own 8 KB.
+            @contextlib.contextmanager
+            def open_zip():
+                with open(data.temp_file, 'rb', buffering=COPY_CHUNK_BYTES) as fp:
+                    with zipfile.ZipFile(fp) as file:
+                        yield file
+
+        # Read the central directory once.
+        try:
+            with open_zip() as file:
+                names = set(file.namelist())
+        except zipfile.BadZipFile:
+            ret.error('File must be a .zip file!')
+            self.remove_download(data)
+            return ret
 
-                info = None
-                try:
-                    info = file.getinfo(f)
-                except KeyError:
-                    pass
+        existing = self.list_local_maps()
 
-                if os.path.exists(out_file):
-                    # Already exists
-                    if info:
-                        ret.files.append(f)
+        work: list[str] = []
+        for f in safe_extract:
+            out_file = os.path.join(self.maps_dir, f)
+
+            # Not in the zip, but let them know if we already have it.
+            if f not in names:
+                if f in existing:
                     ret.error('%s already exists.' % (f))
                     logger.info('Cannot extract file %s because it already exists.' %
                           (out_file))
-                    continue
+                continue
 
-                # File does not exist
-                if not info:
-                    continue
+            work.append(f)
+
+        # Compressed files don't belong in the maps directory,
+        # they all go in one directory that gets removed in one go.
+        if work:
+            ret.compressed_dir = tempfile.mkdtemp(prefix='mapupload_')
+
+        def extract_one(f: str):
+            with open_zip() as file:
+                return self.extract_member(
+                    file,
+                    file.getinfo(f),
+                    os.path.join(self.maps_dir, f),
+                    ret.compressed_dir)
+
+        try:
+            # Inflate and compression release the GIL, so the members
+            # get extracted in parallel.
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(work), 1)) as pool:
+                futures = [pool.submit(extract_one, f) for f in work]
+
+                for f, future in zip(work, futures):
+                    out_file = os.path.join(self.maps_dir, f)
+
+                    try:
+                        compressed_file = future.result()
+                    except FileExistsError:
+                        ret.files.append(f)
+                        ret.error('%s already exists.' % (f))
+                        logger.info('Cannot extract file %s because it already exists.' %
+                              (out_file))
+                        continue
 
-                out_file2 = file.extract(f, self.maps_dir)
-                if out_file2:
                     ret.files.append(out_file)
                     ret.files_extracted.append(out_file)
-
-        os.remove(data.temp_file)
+                    if compressed_file:
+                        ret.files_compressed.append(compressed_file)
+        except BaseException:
+            if ret.compressed_dir:
+                shutil.rmtree(ret.compressed_dir, True)
+            raise
+        finally:
+            # The directory mtime may not have changed if the listing
+            # was cached within the same timestamp tick.
+            if work:
+                self._local_maps = None
+
+        self.remove_download(data)
 
         logger.info('Extracted files:')
         for f in ret.files_extracted:
@@ -732,19 +1376,84 @@ class MyDiscordClient(discord.Client):
 
         return ret
 
-    def compress_to_bz2(self, files: list[str]):
-        compressed_files: list[str] = []
+    """Extracts a single zip member, compressing it for fast-dl
+        in the same pass if it gets uploaded.
+        Returns the compressed file, if any."""
+    def extract_member(self, file: zipfile.ZipFile, info: zipfile.ZipInfo, out_file: str, compressed_dir: str):
+        compressed_file = ''
+        if not self._ignore_re.search(info.filename):
+            compressed_file = os.path.join(
+                compressed_dir,
+                os.path.basename(out_file) + self.compression_ext)
+
+        # Created once we've seen the first chunk.
+        compressor = None
+        level = self.compression_level
+
+        # Fails if the file already exists, even if another
+        # extraction created it after we looked.
+        fd = os.open(
+            out_file,
+            os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0),
+            0o666)
 
-        for uf in files:
-            with open(uf, 'rb') as ufp:
-                cf_name = uf + '.bz2'
-                with bz2.open(cf_name, 'wb', self.bz2_compressionlevel) as cfp:
-                    while True:
-                        chunk = ufp.read(16000)
-                        if not chunk:
-                            break
-                        cfp.write(chunk)
-                    compressed_files.append(cf_name)
+        try:
+            with os.fdopen(fd, 'wb') as dst:
+                cfp = open(compressed_file, 'wb') if compressed_file else None
+                try:
+                    for chunk in _iter_zip_member(file, info, COPY_CHUNK_BYTES):
+                        dst.write(chunk)
+                        if cfp:
+                            if not compressor:
+                                if _is_high_entropy(chunk[:ENTROPY_SAMPLE_BYTES]):
+                                    logger.debug('%s looks incompressible, using level 1.' %
+                                                 (info.filename))
+                                    level = 1
+                                compressor = _new_compressor(self.compression_algorithm, level)
+                            cfp.write(compressor.compress(chunk))
+
+                    if cfp:
+                        if not compressor:
+                            compressor = _new_compressor(self.compression_algorithm, level)
+                        cfp.write(compressor.flush())
+                finally:
+                    if cfp:
+                        cfp.close()
+        except BaseException:
+            # Don't leave half-written files behind.
+            for f in (out_file, compressed_file):
+                if f:
+                    self.remove_file(f)
+            raise
+
+        return compressed_file
+
+    """Compresses the files in parallel.
+        Each compressed file is put in the queue as soon as it's done."""
+    async def compress_to_bz2(self, files: list[str], out_dir: str, queue: 'asyncio.Queue[str | None] | None' = None):
+        # Split the cores between the files compressed at the same time.
+        threads = max(1, (os.cpu_count() or 1) // max(len(files), 1))
+
+        async def compress(f: str):
+            cf = await self.loop.run_in_executor(
+                self._cpu_pool,
+                _compress_one,
+                f,
+                self.compression_level,
+                self._ignore_re,
+                self.compression_algorithm,
+                out_dir,
+                threads)
+
+            if cf and queue is not None:
+                queue.put_nowait(cf)
+
+            return cf
+
+        results = await asyncio.gather(*(compress(f) for f in files))
+
+        # Ignored files come back as None
+        compressed_files = [f for f in results if f is not None]
 
         logger.info('Compressed files:')
         for f in compressed_files:
@@ -752,7 +1461,50 @@ class MyDiscordClient(discord.Client):
 
         return compressed_files
 
-    async def write_response_to_tempfile(self, resp: aiohttp.ClientResponse, ret_data: DownloadFileResponse):
+    """Yields the response body in chunks.
+        Stops as soon as it goes past what we were promised (or our limit)
+        and makes sure we actually got all of it."""
+    async def iter_response(self, resp: aiohttp.ClientResponse, content_len: int):
+        # aiohttp decodes gzip/deflate bodies for us, but Content-Length
+        # is the encoded size, so only our own limit applies then.
+        encoded = resp.headers.get('Content-Encoding', 'identity').lower() != 'identity'
+
+        max_len = self.upload_max_bytes if encoded else min(content_len, self.upload_max_bytes)
+        total = 0
+        while True:
+            chunk = await resp.content.read(self.upload_chunksize)
+            if not chunk:
+                break
+
+            total += len(chunk)
+            if total > max_len:
+                raise aiohttp.ClientPayloadError(
+                    'Response is bigger than %i bytes' % (max_len))
+
+            yield chunk
+
+        if not encoded and total != content_len:
+            raise aiohttp.ClientPayloadError(
+                'Response was cut short (%i/%i bytes)' % (total, content_len))
+
+    async def write_response_to_buffer(self, resp: aiohttp.ClientResponse, ret_data: DownloadFileResponse, content_len=0):
+        chunk_size = self.upload_chunksize
+
+        logger.info('Writing to memory in chunks of %i...' % (chunk_size))
+
+        buf = io.BytesIO()
+        try:
+            async for chunk in self.iter_response(resp, content_len):
+                buf.write(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error('Exception reading content: %s' % (e))
+            return
+
+        buf.seek(0)
+        ret_data.buffer = buf
+        ret_data.success = True
+
+    async def write_response_to_tempfile(self, resp: aiohttp.ClientResponse, ret_data: DownloadFileResponse, content_len=0):
         chunk_size = self.upload_chunksize
 
         with tempfile.NamedTemporaryFile(
@@ -760,20 +1512,82 @@ class MyDiscordClient(discord.Client):
                 delete=False) as fp:
             logger.info('Writing to temporary file %s in chunks of %i...' %
                   (fp.name, chunk_size))
-            while True:
-                chunk = None
-                try:
-                    chunk = await resp.content.read(chunk_size)
-                except (Exception) as e:
-                    logger.error('Exception reading content: %s' % (e))
 
-                if not chunk:
-                    break
-                await self.loop.run_in_executor(None, fp.write, chunk)
+            # Reserve the whole file up front so the filesystem
+            # doesn't have to allocate blocks as we go.
+            preallocated = False
+            if content_len > 0:
+                preallocated = await asyncio.to_thread(self.preallocate_file, fp.fileno(), content_len)
+
+            # Batch the chunks so we don't go through the executor
+            # for every single one of them.
+            # Two buffers, allocated once: one gets filled from the network
+            # while the other one is being written to disk.
+            bufs = [bytearray(WRITE_BATCH_BYTES), bytearray(WRITE_BATCH_BYTES)]
+            cur = 0
+            view = memoryview(bufs[cur])
+            pos = 0
+            pending_write: asyncio.Future | None = None
+            ok = False
+            try:
+                async for chunk in self.iter_response(resp, content_len):
+                    chunk_view = memoryview(chunk)
+                    while chunk_view:
+                        n = min(len(chunk_view), len(view) - pos)
+                        view[pos:pos + n] = chunk_view[:n]
+                        chunk_view = chunk_view[n:]
+                        pos += n
+
+                        if pos == len(view):
+                            # The other buffer has to be written out
+                            # before we can fill it again.
+                            if pending_write:
+                                await pending_write
+                            pending_write = asyncio.create_task(
+                                asyncio.to_thread(fp.write, view))
+
+                            cur ^= 1
+                            view = memoryview(bufs[cur])
+                            pos = 0
+
+                if pending_write:
+                    await pending_write
+                if pos:
+                    await asyncio.to_thread(fp.write, view[:pos])
+
+                ok = True
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error('Exception reading content: %s' % (e))
+            finally:
+                # Don't let the write outlive the file, e.g. when we get cancelled.
+                if pending_write and not pending_write.done():
+                    await asyncio.wait([pending_write])
+
+                # Don't leave a half downloaded file behind.
+                if not ok:
+                    fp.close()
+                    await asyncio.to_thread(self.remove_file, fp.name)
+
+            if not ok:
+                return
+
+            # Get rid of any space we reserved but didn't get data for.
+            if preallocated:
+                await asyncio.to_thread(fp.truncate)
 
             ret_data.temp_file = fp.name
             ret_data.success = True
 
+    def preallocate_file(self, fd: int, size: int):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except (AttributeError, OSError) as e:
+            # Not available on this platform/filesystem, no big deal.
+            logger.debug('Could not preallocate temporary file: %s' % (e))
+            return False
+
+        return True
+
     #
     # Utils
     #
@@ -783,10 +1597,12 @@ class MyDiscordClient(discord.Client):
             return ''
 
         disp = headers['Content-Disposition']
-        match = re.search(
-                r'filename=(?:"|)((?:\w|.)+?)(?:"|)(?:;|$)',
-                disp,
-                re.MULTILINE)
+
+        match = FILENAME_EXT_RE.search(disp)
+        if match:
+            return get_filename_no_ext(urllib.parse.unquote(match.group(1)))
+
+        match = FILENAME_RE.search(disp)
 
         if not match:
             return ''
@@ -803,45 +1619,68 @@ class MyDiscordClient(discord.Client):
     def mapcycle_sort(self, mapname: str):
         lower = mapname.lower()
 
-        match = re.search(self.mapcycle_regex, lower)
+        match = self._mapcycle_re.search(lower)
 
         if not match:
             return lower
 
         return match.group(1)
 
+    """Returns the full map name of a mapcycle line, without comments and other fluff."""
+    def _mapcycle_key(self, lmap: str):
+        lower = lmap.lower()
+
+        match = self._mapcycle_re.search(lower)
+
+        if not match:
+            return lower.strip()
+
+        # The regex may stop at characters like '-', keep the rest of the name.
+        parts = lower[match.start(1):].split(None, 1)
+        if not parts:
+            return match.group(1)
+
+        return parts[0]
+
+    """Maps the map names (without comments and other fluff)
+        to their mapcycle lines."""
+    def _index_mapcycle(self, maps: list[str]):
+        index: dict[str, str] = {}
+        for lmap in maps:
+            index.setdefault(self._mapcycle_key(lmap), lmap)
+
+        return index
+
     def get_ssh_conn_options(self):
         return asyncssh.SSHClientConnectionOptions(
             username=self.sftp_username,
             password=self.sftp_password,
             known_hosts=None,
-            x509_trusted_certs=None)
+            x509_trusted_certs=None,
+            encryption_algs=self.sftp_encryption_algs,
+            mac_algs=self.sftp_mac_algs,
+            compression_algs=self.sftp_compression_algs,
+            # Keep the cached connection alive between uploads.
+            keepalive_interval=30,
+            tcp_keepalive=True)
+
+    def get_config_list(self, config: ConfigParser, section: str, option: str, fallback: str):
+        value = config.get(section, option, fallback=fallback)
+        # asyncssh treats an empty tuple as "use the defaults", an empty list as "none".
+        return tuple(v.strip() for v in value.split(',') if v.strip())
 
     def get_map_files(self, mapname: str, add_local_path=False, upload_only=False):
-        files = [
-            mapname + '.bsp',
-            mapname + '.txt',
-            mapname + '.nav'
-        ]
+        files = list(get_map_file_names(mapname))
 
         # Remove all files not getting uploaded.
         if upload_only:
-            temp = files[:]
-            for f in temp:
-                if re.search(self.bz2_ignore_regex, f):
-                    files.remove(f)
+            files = [f for f in files if not self._ignore_re.search(f)]
 
         # Add full path to files
         # Make sure the files exist.
         if add_local_path:
-            temp = []
-            for f in files:
-                full_path = os.path.join(self.maps_dir, f)
-
-                if os.path.exists(full_path):
-                    temp.append(full_path)
-
-            files = temp
+            existing = self.list_local_maps()
+            files = [os.path.join(self.maps_dir, f) for f in files if f in existing]
 
         return files
 
@@ -851,6 +1690,15 @@ if __name__ == '__main__':
     with open(os.path.join(os.path.dirname(__file__), '.config.ini')) as fp:
         config.read_file(fp)
 
+    # uvloop is a lot faster than the default event loop,
+    # but it isn't available everywhere (Windows).
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info('Using uvloop event loop.')
+    except ImportError:
+        pass
+
     client = MyDiscordClient(config)
 
     try: